@@ -3,12 +3,14 @@ import logging
 import os
 import time
 import uuid
-from collections import defaultdict
+from collections import Counter
+from itertools import islice
 
 import boto3
 import botocore
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, List, Optional, Tuple  # noqa
+from botocore.config import Config
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed  # noqa
+from typing import Any, Dict, Iterable, List, Optional, Tuple  # noqa
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -23,6 +25,30 @@ telegraf_script_path = os.path.join(parent_dir_path, "src", "shell",
 metric_create_script = os.path.join(parent_dir_path, "ardere", "scripts",
                                     "metric_creator.py")
 
+# Script contents read from disk, shared by every ECSManager in this process
+_script_cache = {}  # type: Dict[str, str]
+
+# ECS DescribeServices accepts at most this many services per call
+DESCRIBE_SERVICES_LIMIT = 10
+
+# Default amount of threads used for concurrent AWS API calls, these are
+# network bound so many more threads than CPU's are useful
+DEFAULT_MAX_WORKERS = 32
+
+# Most threads, and client connections, a plan may ask for. Every distinct
+# size gets its own pool and clients that live as long as the process
+MAX_WORKERS = 64
+
+# Retry throttled/failed AWS calls inside botocore, adaptive mode adds
+# client side rate limiting when AWS starts throttling us
+CLIENT_RETRIES = {"mode": "adaptive", "max_attempts": 10}
+
+# How long, in seconds, EC2 instance query results are reused for
+INSTANCE_CACHE_TTL = 30
+
+# How long, in seconds, a cluster found to exist is trusted for
+CLUSTER_CACHE_TTL = 600
+
 # EC2 userdata to setup values on load
 # Settings for net.ipv4 settings based on:
 #    http://stackoverflow.com/questions/410616/increasing-the-maximum-number-of-tcp-ip-connections-in-linux
@@ -61,6 +87,13 @@ sysctl -w fs.file-max=1000000
 ulimit -n 1000000
 """
 
+# Entrypoint of the telegraf container run alongside each step
+TELEGRAF_ENTRYPOINT = ['sh', '-c', """\
+        echo "${__ARDERE_TELEGRAF_CONF__}" > /etc/telegraf/telegraf.conf && \
+        export __ARDERE_TELEGRAF_HOST__=`wget -qO- http://169.254.169.254/latest/meta-data/instance-id` && \
+        telegraf \
+        """]  # noqa
+
 # List tracking vcpu's of all instance types for cpu unit reservations
 # We are intentionally leaving out the following instance types as they're
 # considered overkill for load-testing purposes or any instance req's we have
@@ -88,18 +121,59 @@ for vcpu, instance_types in ec2_type_by_vcpu.items():
     for instance_type in instance_types:
         ec2_vcpu_by_type[instance_type] = vcpu
 
+# Build a list of cpu units to allocate by instance type
+#
+# We calculate cpu_units as 1024 * vcpu's for each instance to allocate
+# almost the entirety of the instance's cpu units to the load-testing
+# container. We take out 512 to ensure some leftover capacity for other
+# utility containers we run with the load-testing container.
+ec2_cpu_units_by_type = {
+    instance_type: (vcpu * 1024) - 512
+    for instance_type, vcpu in ec2_vcpu_by_type.items()
+}
+
 
 def cpu_units_for_instance_type(instance_type):
     # type: (str) -> int
-    """Calculate how many CPU units to allocate for an instance_type
+    """Return how many CPU units to allocate for an instance_type"""
+    return ec2_cpu_units_by_type[instance_type]
+
+
+def read_script(path):
+    # type: (str) -> str
+    """Read a script from disk once per process"""
+    if path not in _script_cache:
+        with open(path, 'r') as f:
+            _script_cache[path] = f.read()
+    return _script_cache[path]
+
+
+def step_deadline(start_time, step):
+    # type: (float, Dict[str, Any]) -> float
+    """Return the time a step should be stopped at for a plan started at
+    start_time"""
+    return start_time + step.get("run_delay", 0) + step["run_max_time"]
+
+
+def chunk_list(items, size):
+    # type: (Iterable[Any], int) -> Iterable[List[Any]]
+    """Yield successive lists of at most size items from items"""
+    iterator = iter(items)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def task_definition_family(task_arn):
+    # type: (str) -> str
+    """Return the family name of a task definition ARN
 
-    We calculate cpu_units as 1024 * vcpu's for each instance to allocate
-    almost the entirety of the instance's cpu units to the load-testing
-    container. We take out 512 to ensure some leftover capacity for other
-    utility containers we run with the load-testing container.
+    Task definition ARN's are of the form:
+    arn:aws:ecs:REGION:ACCOUNT:task-definition/FAMILY:REVISION
 
     """
-    return (ec2_vcpu_by_type[instance_type] * 1024) - 512
+    return task_arn.rsplit("/", 1)[-1].rsplit(":", 1)[0]
 
 
 class ECSManager(object):
@@ -120,15 +194,33 @@ class ECSManager(object):
     grafana_container = "grafana/grafana:4.1.2"
     python_container = "jfloff/alpine-python:2.7-slim"
 
-    _wait_script = None
-    _telegraf_script = None
-    _metric_create_script = None
+    # Clients shared across ECSManager instances, keyed by the boto module,
+    # service name, and connection pool size
+    _clients = {}  # type: Dict[Tuple[Any, str, int], Any]
+
+    # Thread pools shared across ECSManager instances, keyed by size
+    _executors = {}  # type: Dict[int, ThreadPoolExecutor]
+
+    # When clusters found to exist should be checked again, keyed by the
+    # boto module and cluster name
+    _known_clusters = {}  # type: Dict[Tuple[Any, str], float]
 
     def __init__(self, plan):
         # type: (Dict[str, Any]) -> None
         """Create and return a ECSManager for a cluster of the given name."""
-        self._ecs_client = self.boto.client('ecs')
-        self._ec2_client = self.boto.client('ec2')
+        # The plan is only validated by the first step, so an invalid
+        # value falls back to the default here and is rejected there
+        try:
+            max_workers = int(
+                plan.get("max_workers") or
+                os.environ.get("max_workers", DEFAULT_MAX_WORKERS)
+            )
+        except (TypeError, ValueError):
+            max_workers = DEFAULT_MAX_WORKERS
+        self._max_workers = min(max(max_workers, 1), MAX_WORKERS)
+
+        self._ecs_client = self._get_client('ecs')
+        self._ec2_client = self._get_client('ec2')
         self._ecs_name = plan["ecs_name"]
         self._plan = plan
 
@@ -141,27 +233,58 @@ class ECSManager(object):
             plan["plan_run_uuid"] = uuid.uuid4().hex
 
         self._plan_uuid = plan["plan_run_uuid"]
+        self.s3_ready_key = "{}.ready".format(self._plan_uuid)
+
+        # Active instance types and tags, with the time queried
+        self._instances_cache = None  # type: Optional[Tuple[float, List[Tuple[str, Dict[str, str]]]]]  # noqa
+
+        # Container definition parts shared by the steps, built on use
+        self._log_config = None  # type: Optional[Dict[str, Any]]
+        self._telegraf_def = None  # type: Optional[Dict[str, Any]]
+
+    def _get_client(self, service_name):
+        # type: (str) -> Any
+        """Return a shared client for an AWS service
+
+        Clients are thread-safe and expensive to create, so one client is
+        reused by every ECSManager with the same pool size.
+
+        """
+        key = (self.boto, service_name, self._max_workers)
+        if key not in self._clients:
+            # Size the connection pool to match our threads
+            config = Config(retries=CLIENT_RETRIES,
+                            max_pool_connections=self._max_workers)
+            self._clients[key] = self.boto.client(service_name, config=config)
+        return self._clients[key]
+
+    @property
+    def _executor(self):
+        # type: () -> ThreadPoolExecutor
+        """Return the thread pool shared by every ECSManager with the same
+        amount of workers
+
+        Threads are only started as calls are submitted and then kept, so
+        repeated polls reuse them rather than starting new threads.
+
+        """
+        if self._max_workers not in self._executors:
+            self._executors[self._max_workers] = ThreadPoolExecutor(
+                max_workers=self._max_workers
+            )
+        return self._executors[self._max_workers]
 
     @property
     def wait_script(self):
-        if not self._wait_script:
-            with open(wait_script_path, 'r') as f:
-                self._wait_script = f.read()
-        return self._wait_script
+        return read_script(wait_script_path)
 
     @property
     def telegraf_script(self):
-        if not self._telegraf_script:
-            with open(telegraf_script_path, 'r') as f:
-                self._telegraf_script = f.read()
-        return self._telegraf_script
+        return read_script(telegraf_script_path)
 
     @property
     def metric_create_script(self):
-        if not self._metric_create_script:
-            with open(metric_create_script, 'r') as f:
-                self._metric_create_script = f.read()
-        return self._metric_create_script
+        return read_script(metric_create_script)
 
     @property
     def plan_uuid(self):
@@ -171,19 +294,50 @@ class ECSManager(object):
     def s3_ready_file(self):
         return "https://s3.amazonaws.com/{bucket}/{key}".format(
             bucket=self.s3_ready_bucket,
-            key="{}.ready".format(self._plan_uuid)
+            key=self.s3_ready_key
         )
 
     @property
     def log_config(self):
-        return {
-            "logDriver": "awslogs",
-            "options": {"awslogs-group": self.container_log_group,
-                        "awslogs-region": "us-east-1",
-                        "awslogs-stream-prefix":
-                            "ardere-{}".format(self.plan_uuid)
-                        }
-        }
+        if not self._log_config:
+            self._log_config = {
+                "logDriver": "awslogs",
+                "options": {"awslogs-group": self.container_log_group,
+                            "awslogs-region": "us-east-1",
+                            "awslogs-stream-prefix":
+                                "ardere-{}".format(self.plan_uuid)
+                            }
+            }
+        return self._log_config
+
+    @property
+    def _base_telegraf_def(self):
+        # type: () -> Dict[str, Any]
+        """The parts of the telegraf container definition shared by every
+        step, callers copy it and add the per-step environment"""
+        if not self._telegraf_def:
+            self._telegraf_def = {
+                "name": "telegraf",
+                "image": self.telegraf_container,
+                "cpu": 512,
+                "memoryReservation": 256,
+                "entryPoint": TELEGRAF_ENTRYPOINT,
+                "portMappings": [
+                    {"containerPort": 8125}
+                ],
+                "privileged": True,
+                "environment": [
+                    {"name": "__ARDERE_TELEGRAF_CONF__",
+                     "value": self.telegraf_script},
+                    {"name": "__ARDERE_INFLUX_ADDR__",
+                     "value": "{}:8086".format(
+                         self._plan["influxdb_private_ip"])},
+                    {"name": "__ARDERE_INFLUX_DB__",
+                     "value": self.influx_db_name}
+                ],
+                "logConfiguration": self.log_config
+            }
+        return self._telegraf_def
 
     @property
     def influx_db_name(self):
@@ -214,39 +368,80 @@ class ECSManager(object):
 
     def query_active_instances(self, additional_tags=None):
         # type: (Optional[Dict[str, str]]) -> Dict[str, int]
-        """Query EC2 for all the instances owned by ardere for this cluster."""
-        instance_dict = defaultdict(int)
+        """Query EC2 for all the instances owned by ardere for this cluster.
+
+        Every instance in the cluster is described once and cached for
+        INSTANCE_CACHE_TTL seconds, additional_tags are matched against
+        the cached instances.
+
+        """
+        cached = self._instances_cache
+        if not cached or time.time() - cached[0] >= INSTANCE_CACHE_TTL:
+            cached = (time.time(), self._describe_active_instances())
+            self._instances_cache = cached
+
+        additional_tags = additional_tags or {}
+        return Counter(
+            instance_type for instance_type, tags in cached[1]
+            if all(tags.get(tag_name) == tag_value
+                   for tag_name, tag_value in additional_tags.items())
+        )
+
+    def _describe_active_instances(self):
+        # type: () -> List[Tuple[str, Dict[str, str]]]
+        """Return the instance type and tags of every pending/running
+        instance in this cluster"""
         paginator = self._ec2_client.get_paginator('describe_instances')
-        filters = {"Owner": "ardere", "ECSCluster": self._ecs_name}
-        if additional_tags:
-            filters.update(additional_tags)
         response_iterator = paginator.paginate(
             Filters=[
+                {"Name": "tag:Owner", "Values": ["ardere"]},
+                {"Name": "tag:ECSCluster", "Values": [self._ecs_name]},
+                # Let EC2 drop shutting down/terminated instances
                 {
-                    "Name": "tag:{}".format(tag_name),
-                    "Values": [tag_value]
-                } for tag_name, tag_value in filters.items()
-            ]
+                    "Name": "instance-state-name",
+                    "Values": ["pending", "running"]
+                }
+            ],
+            PaginationConfig={"PageSize": 1000}
         )
-        for page in response_iterator:
-            for reservation in page["Reservations"]:
-                for instance in reservation["Instances"]:
-                    # Determine if the instance is pending/running and count
-                    # 0 = Pending, 16 = Running, > is all shutting down, etc.
-                    if instance["State"]["Code"] <= 16:
-                        instance_dict[instance["InstanceType"]] += 1
-        return instance_dict
+        return [
+            (instance_type, {tag["Key"]: tag["Value"] for tag in tags or []})
+            for instance_type, tags in response_iterator.search(
+                "Reservations[].Instances[].[InstanceType, Tags]"
+            )
+        ]
 
     def calculate_missing_instances(self, desired, current):
         # type: (Dict[str, int], Dict[str, int]) -> Dict[str, int]
         """Determine how many of what instance types are needed to ensure
         the current instance dict has all the desired instance count/types."""
-        needed = {}
-        for instance_type, instance_count in desired.items():
-            cur = current.get(instance_type, 0)
-            if cur < instance_count:
-                needed[instance_type] = instance_count - cur
-        return needed
+        # Counter subtraction drops any types with no shortfall
+        return dict(Counter(desired) - Counter(current))
+
+    def start_cluster_check(self):
+        # type: () -> Future
+        """Start checking that the plan's ECS cluster exists
+
+        Returns a future for whether it does, so the check can overlap
+        with the instance queries. A cluster that exists isn't described
+        again for CLUSTER_CACHE_TTL seconds.
+
+        """
+        return self._executor.submit(self._cluster_exists)
+
+    def _cluster_exists(self):
+        # type: () -> bool
+        key = (self.boto, self._ecs_name)
+        if self._known_clusters.get(key, 0) > time.time():
+            return True
+
+        response = self._ecs_client.describe_clusters(
+            clusters=[self._ecs_name]
+        )
+        if not response.get("clusters"):
+            return False
+        self._known_clusters[key] = time.time() + CLUSTER_CACHE_TTL
+        return True
 
     def has_metrics_node(self, instance_type):
         # type: (str) -> bool
@@ -256,24 +451,29 @@ class ECSManager(object):
         )
         return instance_type in instances
 
-    def has_started_metric_creation(self):
-        # type: () -> bool
-        """Return whether the metric creation container was started"""
+    def metric_creation_state(self):
+        # type: () -> Tuple[bool, bool]
+        """Return whether the metric creation container was started and
+        whether it has finished
+
+        ListTasks only returns RUNNING tasks unless asked otherwise, so the
+        STOPPED tasks are checked first. A finished container needs only
+        that one call.
+
+        """
         response = self._ecs_client.list_tasks(
             cluster=self._ecs_name,
-            startedBy=self.plan_uuid
+            startedBy=self.plan_uuid,
+            desiredStatus="STOPPED"
         )
-        return bool(response["taskArns"])
+        if response["taskArns"]:
+            return True, True
 
-    def has_finished_metric_creation(self):
-        # type: () -> bool
-        """Return whether the metric creation container has finished"""
         response = self._ecs_client.list_tasks(
             cluster=self._ecs_name,
-            startedBy=self.plan_uuid,
-            desiredStatus="STOPPED"
+            startedBy=self.plan_uuid
         )
-        return bool(response["taskArns"])
+        return bool(response["taskArns"]), False
 
     def request_instances(self, instances, security_group_ids,
                           additional_tags=None):
@@ -284,26 +484,40 @@ class ECSManager(object):
                     ECSCluster=self._ecs_name)
         if additional_tags:
             tags.update(additional_tags)
-        for instance_type, instance_count in instances.items():
+
+        # Identical for every instance type, so build them once
+        user_data = EC2_USER_DATA.format(ecs_name=self._ecs_name)
+        tag_specs = [
+            {
+                "ResourceType": "instance",
+                "Tags": [
+                    dict(Key=tag_name, Value=tag_value)
+                    for tag_name, tag_value in tags.items()
+                ]
+            }
+        ]
+
+        def run_instances(item):
+            instance_type, instance_count = item
             self._ec2_client.run_instances(
                 ImageId=ami_id,
                 MinCount=instance_count,
                 MaxCount=instance_count,
                 InstanceType=instance_type,
-                UserData=EC2_USER_DATA.format(ecs_name=self._ecs_name),
+                UserData=user_data,
                 IamInstanceProfile={"Arn": self.ecs_profile},
                 SecurityGroupIds=security_group_ids,
-                TagSpecifications=[
-                    {
-                        "ResourceType": "instance",
-                        "Tags": [
-                            dict(Key=tag_name, Value=tag_value)
-                            for tag_name, tag_value in tags.items()
-                        ]
-                    }
-                ]
+                TagSpecifications=tag_specs
             )
 
+        # Request each instance type concurrently
+        items = list(instances.items())
+        try:
+            list(self._executor.map(run_instances, items))
+        finally:
+            # Instance counts have changed, requery them next time
+            self._instances_cache = None
+
     def locate_metrics_container_ip(self):
         # type: () -> Tuple[Optional[str], Optional[str]]
         """Locates the metrics container IP and container instance arn
@@ -326,8 +540,13 @@ class ECSManager(object):
 
         container_instance = response["containerInstances"][0]
         ec2_instance_id = container_instance["ec2InstanceId"]
-        instance = self.boto.resource("ec2").Instance(ec2_instance_id)
-        return instance.private_ip_address, container_arn
+
+        # Use the shared EC2 client rather than building an ec2 resource
+        response = self._ec2_client.describe_instances(
+            InstanceIds=[ec2_instance_id]
+        )
+        instance = response["Reservations"][0]["Instances"][0]
+        return instance.get("PrivateIpAddress"), container_arn
 
     def locate_metrics_service(self):
         # type: () -> Optional[str]
@@ -346,8 +565,7 @@ class ECSManager(object):
         # type: (Dict[str, Any]) -> Dict[str, Any]
         """Creates an ECS service to run InfluxDB and Grafana for metric
         reporting and returns its info"""
-        logger.info("Creating InfluxDB service with options: {}".format(
-            options))
+        logger.info("Creating InfluxDB service with options: %s", options)
 
         cmd = """\
         export GF_DEFAULT_INSTANCE_NAME=`wget -qO- http://169.254.169.254/latest/meta-data/instance-id` && \
@@ -491,7 +709,13 @@ class ECSManager(object):
     def create_service(self, step):
         # type: (Dict[str, Any]) -> Dict[str, Any]
         """Creates an ECS service for a step and returns its info"""
-        logger.info("CreateService called with: {}".format(step))
+        logger.info("CreateService called with: %s", step)
+        self._register_task(step)
+        return self._create_service_for_task(step)
+
+    def _register_task(self, step):
+        # type: (Dict[str, Any]) -> str
+        """Registers the task definition for a step and returns its arn"""
 
         # Prep the shell command
         wfc_var = '__ARDERE_WAITFORCLUSTER_SH__'
@@ -509,7 +733,7 @@ class ECSManager(object):
             env_vars.append({"name": name, "value": value})
 
         # ECS wants a family name for task definitions, no spaces, 255 chars
-        family_name = step["name"] + "-" + self._plan_uuid
+        family_name = self.family_name(step)
 
         # Use cpu_unit if provided, otherwise monopolize
         cpu_units = step.get(
@@ -538,36 +762,13 @@ class ECSManager(object):
             container_def["portMappings"] = ports
 
         # Setup the telegraf container definition
-        cmd = """\
-        echo "${__ARDERE_TELEGRAF_CONF__}" > /etc/telegraf/telegraf.conf && \
-        export __ARDERE_TELEGRAF_HOST__=`wget -qO- http://169.254.169.254/latest/meta-data/instance-id` && \
-        telegraf \
-        """  # noqa
-        cmd = ['sh', '-c', '{}'.format(cmd)]
-        telegraf_def = {
-            "name": "telegraf",
-            "image": self.telegraf_container,
-            "cpu": 512,
-            "memoryReservation": 256,
-            "entryPoint": cmd,
-            "portMappings": [
-                {"containerPort": 8125}
-            ],
-            "privileged": True,
-            "environment": [
-                {"name": "__ARDERE_TELEGRAF_CONF__",
-                 "value": self.telegraf_script},
-                {"name": "__ARDERE_TELEGRAF_STEP__",
-                 "value": step["name"]},
-                {"name": "__ARDERE_INFLUX_ADDR__",
-                 "value": "{}:8086".format(self._plan["influxdb_private_ip"])},
-                {"name": "__ARDERE_INFLUX_DB__",
-                 "value": self.influx_db_name},
-                {"name": "__ARDERE_TELEGRAF_TYPE__",
-                 "value": step["docker_series"]}
-            ],
-            "logConfiguration": self.log_config
-        }
+        telegraf_def = dict(self._base_telegraf_def)
+        telegraf_def["environment"] = telegraf_def["environment"] + [
+            {"name": "__ARDERE_TELEGRAF_STEP__",
+             "value": step["name"]},
+            {"name": "__ARDERE_TELEGRAF_TYPE__",
+             "value": step["docker_series"]}
+        ]
 
         task_response = self._ecs_client.register_task_definition(
             family=family_name,
@@ -589,10 +790,15 @@ class ECSManager(object):
         )
         task_arn = task_response["taskDefinition"]["taskDefinitionArn"]
         step["taskArn"] = task_arn
+        return task_arn
+
+    def _create_service_for_task(self, step):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """Creates the ECS service for a step's registered task definition"""
         service_result = self._ecs_client.create_service(
             cluster=self._ecs_name,
             serviceName=step["name"],
-            taskDefinition=task_arn,
+            taskDefinition=step["taskArn"],
             desiredCount=step["instance_count"],
             deploymentConfiguration={
                 "minimumHealthyPercent": 0,
@@ -610,66 +816,114 @@ class ECSManager(object):
 
     def create_services(self, steps):
         # type: (List[Dict[str, Any]]) -> None
-        """Create ECS Services given a list of steps"""
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            list(executor.map(self.create_service, steps))
-
-    def service_ready(self, step):
-        # type: (Dict[str, Any]) -> bool
-        """Query a service and return whether all its tasks are running"""
-        service_name = step["name"]
-        response = self._ecs_client.describe_services(
-            cluster=self._ecs_name,
-            services=[service_name]
-        )
+        """Create ECS Services given a list of steps
 
-        try:
-            deploy = response["services"][0]["deployments"][0]
-        except (TypeError, IndexError):
-            return False
-        return deploy["desiredCount"] == deploy["runningCount"]
+        All the task definitions are registered before any service is
+        created, so each phase runs fully in parallel across the steps.
+
+        """
+        logger.info("CreateServices called for %s steps", len(steps))
+        self._run_for_steps(self._register_task, steps)
+        self._run_for_steps(self._create_service_for_task, steps)
+
+    def _run_for_steps(self, func, steps):
+        # type: (Any, List[Dict[str, Any]]) -> None
+        """Run func for every step on the thread pool, logging each failure
+        as it completes
+
+        Every call is allowed to finish, then the first failure is raised.
+
+        """
+        futures = {self._executor.submit(func, step): step for step in steps}
+        errors = []
+        for future in as_completed(futures):
+            exc, tb = future.exception_info()
+            if exc:
+                logger.error("%s failed for step %s: %s", func.__name__,
+                             futures[future]["name"], exc,
+                             exc_info=(type(exc), exc, tb))
+                errors.append(exc)
+        if errors:
+            raise errors[0]
+
+    def describe_services(self, service_names):
+        # type: (List[str]) -> Dict[str, Dict[str, Any]]
+        """Describe the named services, returning a dict of service info
+        keyed by service name
+
+        Services are described in batches of up to 10, the most ECS accepts
+        in a single DescribeServices call. Services ECS doesn't know about
+        are left out of the result.
+
+        """
+        def describe(names):
+            response = self._ecs_client.describe_services(
+                cluster=self._ecs_name,
+                services=names
+            )
+            return response["services"]
+
+        chunks = list(chunk_list(service_names, DESCRIBE_SERVICES_LIMIT))
+        results = self._executor.map(describe, chunks)
+        return {service["serviceName"]: service
+                for services in results for service in services}
 
     def all_services_ready(self, steps):
         # type: (List[Dict[str, Any]]) -> bool
-        """Queries all service ARN's in the plan to see if they're ready"""
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            results = executor.map(self.service_ready, steps)
-        return all(results)
-
-    def service_done(self, step):
-        # type: (Dict[str, Any]) -> bool
-        """Query a service to return whether its fully drained and back to
-        INACTIVE"""
-        service_name = step["name"]
-        response = self._ecs_client.describe_services(
-            cluster=self._ecs_name,
-            services=[service_name]
-        )
+        """Queries all service ARN's in the plan to see if they're ready
+
+        A throttled check counts as not ready, the Step Function retry
+        checks again later.
+
+        """
+        try:
+            services = self.describe_services([step["name"] for step in steps])
+        except botocore.exceptions.ClientError as exc:
+            if exc.response["Error"].get("Code") != "ThrottlingException":
+                raise
+            logger.info("Throttled checking services")
+            return False
 
-        service = response["services"][0]
-        return service["status"] == "INACTIVE"
+        for step in steps:
+            try:
+                deploy = services[step["name"]]["deployments"][0]
+            except (KeyError, IndexError):
+                return False
+            if deploy["desiredCount"] != deploy["runningCount"]:
+                return False
+        return True
 
     def all_services_done(self, steps):
         # type: (List[Dict[str, Any]]) -> bool
         """Queries all service ARN's in the plan to see if they're fully
-        DRAINED and now INACTIVE"""
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            results = executor.map(self.service_done, steps)
-        return all(results)
-
-    def stop_finished_service(self, start_time, step):
-        # type: (start_time, Dict[str, Any]) -> None
-        """Stops a service if it needs to shutdown"""
-        if step["service_status"] == "STOPPED":
-            return
+        DRAINED and now INACTIVE
+
+        Services ECS no longer knows about are considered done.
+
+        """
+        services = self.describe_services([step["name"] for step in steps])
+        return all(service["status"] == "INACTIVE"
+                   for service in services.values())
+
+    def stop_finished_services(self, start_time, steps):
+        # type: (int, List[Dict[str, Any]]) -> None
+        """Shuts down any services that have run for their max time
+
+        The services that are due are stopped concurrently.
 
-        # Calculate time
-        step_duration = step.get("run_delay", 0) + step["run_max_time"]
+        """
         now = time.time()
-        if now < (start_time + step_duration):
+        due = [step for step in steps
+               if step["service_status"] != "STOPPED" and
+               step_deadline(start_time, step) <= now]
+        if not due:
             return
 
-        # Running long enough to shutdown
+        list(self._executor.map(self._stop_service, due))
+
+    def _stop_service(self, step):
+        # type: (Dict[str, Any]) -> None
+        """Scale a step's service down to 0 and mark it stopped"""
         self._ecs_client.update_service(
             cluster=self._ecs_name,
             service=step["name"],
@@ -677,12 +931,6 @@ class ECSManager(object):
         )
         step["service_status"] = "STOPPED"
 
-    def stop_finished_services(self, start_time, steps):
-        # type: (int, List[Dict[str, Any]]) -> None
-        """Shuts down any services that have run for their max time"""
-        for step in steps:
-            self.stop_finished_service(start_time, step)
-
     def shutdown_plan(self, steps):
         # type: (List[Dict[str, Any]]) -> None
         """Terminate the entire plan, ensure all services and task
@@ -690,7 +938,8 @@ class ECSManager(object):
         # Locate all the services for the ECS Cluster
         paginator = self._ecs_client.get_paginator('list_services')
         response_iterator = paginator.paginate(
-            cluster=self._ecs_name
+            cluster=self._ecs_name,
+            PaginationConfig={"PageSize": 100}
         )
 
         # Collect all the service ARN's
@@ -706,46 +955,82 @@ class ECSManager(object):
             if metric_service and metric_service["serviceArn"] in service_arns:
                 service_arns.remove(metric_service["serviceArn"])
 
-        for service_arn in service_arns:
-            try:
-                self._ecs_client.update_service(
-                    cluster=self._ecs_name,
-                    service=service_arn,
-                    desiredCount=0
-                )
-            except botocore.exceptions.ClientError:
-                continue
-
-            try:
-                self._ecs_client.delete_service(
-                    cluster=self._ecs_name,
-                    service=service_arn
-                )
-            except botocore.exceptions.ClientError:
-                pass
+        list(self._executor.map(self._drain_and_delete_service, service_arns))
 
-        # Locate all the task definitions for this plan
-        step_family_names = [self.family_name(step) for step in steps]
+        # Deregister the task definitions recorded when the steps were
+        # registered, looking up the families of any that weren't
+        task_arns = [step["taskArn"] for step in steps if step.get("taskArn")]
+        family_names = [self.family_name(step) for step in steps
+                        if not step.get("taskArn")]
 
         # Add in the metrics family name if we need to tear_down
         if self._plan["metrics_options"]["tear_down"]:
-            step_family_names.append(self.metrics_family_name())
-            step_family_names.append(self.metrics_setup_family_name())
+            family_names.append(self.metrics_family_name())
+            family_names.append(self.metrics_setup_family_name())
 
-        for family_name in step_family_names:
-            try:
-                response = self._ecs_client.describe_task_definition(
-                    taskDefinition=family_name
-                )
-            except botocore.exceptions.ClientError:
-                continue
+        for family_arns in self._executor.map(self._active_task_definitions,
+                                              family_names):
+            task_arns.extend(family_arns)
 
-            task_arn = response["taskDefinition"]["taskDefinitionArn"]
+        list(self._executor.map(self._deregister_task_definition, task_arns))
 
-            # Deregister the task
-            try:
-                self._ecs_client.deregister_task_definition(
-                    taskDefinition=task_arn
-                )
-            except botocore.exceptions.ClientError:
-                pass
+    def _active_task_definitions(self, family_name):
+        # type: (str) -> List[str]
+        """Return the ARN's of a family's active task definitions
+
+        A family that can't be listed is skipped, so the rest of the plan
+        is still cleaned up.
+
+        """
+        paginator = self._ecs_client.get_paginator('list_task_definitions')
+        try:
+            response_iterator = paginator.paginate(
+                familyPrefix=family_name,
+                status="ACTIVE",
+                PaginationConfig={"PageSize": 100}
+            )
+            # The prefix also matches longer family names
+            return [
+                task_arn
+                for page in response_iterator
+                for task_arn in page["taskDefinitionArns"]
+                if task_definition_family(task_arn) == family_name
+            ]
+        except botocore.exceptions.ClientError:
+            logger.warning("Unable to list task definitions: %s",
+                           family_name, exc_info=True)
+            return []
+
+    def _drain_and_delete_service(self, service_arn):
+        # type: (str) -> None
+        """Scale a service down to 0 and delete it"""
+        try:
+            self._ecs_client.update_service(
+                cluster=self._ecs_name,
+                service=service_arn,
+                desiredCount=0
+            )
+        except botocore.exceptions.ClientError:
+            logger.warning("Unable to drain service: %s", service_arn,
+                           exc_info=True)
+            return
+
+        try:
+            self._ecs_client.delete_service(
+                cluster=self._ecs_name,
+                service=service_arn
+            )
+        except botocore.exceptions.ClientError:
+            logger.warning("Unable to delete service: %s", service_arn,
+                           exc_info=True)
+
+    def _deregister_task_definition(self, task_arn):
+        # type: (str) -> None
+        """Deregister a task definition"""
+        try:
+            self._ecs_client.deregister_task_definition(
+                taskDefinition=task_arn
+            )
+        except botocore.exceptions.ClientError:
+            logger.warning("Unable to deregister task definition: %s",
+                           task_arn, exc_info=True)
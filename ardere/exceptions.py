@@ -16,3 +16,7 @@ class UndrainedInstancesException(Exception):
 
 class CreatingMetricSourceException(Exception):
     """Metric creation task hasn't completed yet"""
+
+
+class ReadyFileMissingException(Exception):
+    """The ready file for the plan could not be found"""
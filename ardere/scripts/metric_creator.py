@@ -5,6 +5,7 @@ import os
 import boto3
 import influxdb
 import requests
+from requests.packages.urllib3.util.retry import Retry
 
 try:
     from typing import Any, Dict  # noqa
@@ -14,6 +15,12 @@ except ImportError:  # pragma: nocover
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+# Retry grafana requests with backoff while it's still starting up. The
+# datasource and dashboard POSTs need retrying too, so no method is left out
+GRAFANA_RETRIES = Retry(total=5, backoff_factor=0.3,
+                        status_forcelist=(502, 503, 504),
+                        method_whitelist=False)
+
 
 class DashboardSetup(object):
     # For testing purposes
@@ -29,16 +36,28 @@ class DashboardSetup(object):
             os.environ.get("__ARDERE_GRAFANA_USER__"),
             os.environ.get("__ARDERE_GRAFANA_PASS__")
         )
+        self._session = None
+
+    @property
+    def session(self):
+        # type: () -> requests.Session
+        """Return a keep-alive session authenticated against grafana"""
+        if not self._session:
+            session = self.req.Session()
+            session.auth = self.grafana_auth
+            session.mount("http://", self.req.adapters.HTTPAdapter(
+                max_retries=GRAFANA_RETRIES))
+            self._session = session
+        return self._session
 
     def _load_dashboard(self):
         # type: () -> Dict[str, Any]
         """Load dashboard from S3 and update JSON contents"""
         logger.info("Fetching dashboard from S3")
         bucket, filename = self.dashboard.split(":")
-        s3 = self.boto.resource('s3')
-        dash_file = s3.Object(bucket, filename)
-        file_contents = dash_file.get()['Body'].read().decode('utf-8')
-        dash_contents = json.loads(file_contents)
+        s3_client = self.boto.client('s3')
+        response = s3_client.get_object(Bucket=bucket, Key=filename)
+        dash_contents = json.load(response['Body'])
         dash_contents["title"] = self.dashboard_name
         dash_contents["id"] = None
         logger.info("Fetched dashboard file")
@@ -49,12 +68,11 @@ class DashboardSetup(object):
         """Create the dashboard in grafana"""
         dash_contents = self._load_dashboard()
         logger.info("Creating dashboard in grafana")
-        response = self.req.post(grafana_url + "/api/dashboards/db",
-                                 auth=self.grafana_auth,
-                                 json=dict(
-                                     dashboard=dash_contents,
-                                     overwrite=True
-                                 ))
+        response = self.session.post(grafana_url + "/api/dashboards/db",
+                                     json=dict(
+                                         dashboard=dash_contents,
+                                         overwrite=True
+                                     ))
         if response.status_code != 200:
             raise Exception("Error creating dashboard: {}".format(
                 response.status_code))
@@ -63,16 +81,14 @@ class DashboardSetup(object):
         # type: (str) -> None
         """Ensure the dashboard is present"""
         # Verify whether the dashboard exists
-        response = self.req.get(grafana_url + "/api/search",
-                                auth=self.grafana_auth,
-                                params=dict(query=self.dashboard_name))
+        response = self.session.get(grafana_url + "/api/search",
+                                    params=dict(query=self.dashboard_name))
         if response.status_code != 200:
             raise Exception("Failure to search dashboards")
 
         # search results for dashboard
-        results = filter(lambda x: x["title"] == self.dashboard_name,
-                         response.json())
-        if not results:
+        if not any(x["title"] == self.dashboard_name
+                   for x in response.json()):
             self._create_dashboard(grafana_url)
 
     def create_datasources(self):
@@ -86,7 +102,7 @@ class DashboardSetup(object):
         grafana_url = "http://127.0.0.1:3000"
         ds_api_url = "http://127.0.0.1:3000/api/datasources"
         logger.info("Create datasource in grafana")
-        self.req.post(ds_api_url, auth=self.grafana_auth, json=dict(
+        self.session.post(ds_api_url, json=dict(
             name=self.influx_db_name,
             type="influxdb",
             url="http://localhost:8086",
@@ -1,12 +1,11 @@
 import logging
 import os
-import re
 import time
-from collections import defaultdict
+from collections import Counter
 
 import boto3
 import botocore
-import toml
+from botocore.config import Config
 from marshmallow import (
     Schema,
     decorators,
@@ -17,11 +16,14 @@ from marshmallow import (
 from typing import Any, Dict, List  # noqa
 
 from ardere.aws import (
+    CLIENT_RETRIES,
     ECSManager,
+    MAX_WORKERS,
     ec2_vcpu_by_type,
 )
 from ardere.exceptions import (
     CreatingMetricSourceException,
+    ReadyFileMissingException,
     ServicesStartingException,
     ShutdownPlanException,
     ValidationException,
@@ -38,7 +40,13 @@ logger.setLevel(logging.INFO)
 # where UUID is dashed, and LUUID is not
 # therefore: 512 - (9 + 36 + 32) = max name len
 MAX_NAME_LEN = 435
-INVALID_NAME_CHECK = re.compile("([:\*]+)")
+INVALID_NAME_CHARS = frozenset(":*")
+
+# On Python 2 dict.keys() is a list, so OneOf would scan it per field
+VALID_INSTANCE_TYPES = frozenset(ec2_vcpu_by_type)
+
+# S3 calls are made one at a time, so only the retry behaviour is changed
+S3_CONFIG = Config(retries=CLIENT_RETRIES)
 
 
 class StepValidator(Schema):
@@ -46,7 +54,7 @@ class StepValidator(Schema):
     instance_count = fields.Int(required=True)
     instance_type = fields.String(
         required=True,
-        validate=validate.OneOf(ec2_vcpu_by_type.keys())
+        validate=validate.OneOf(VALID_INSTANCE_TYPES)
     )
     run_max_time = fields.Int(required=True)
     run_delay = fields.Int(missing=0)
@@ -62,7 +70,7 @@ class StepValidator(Schema):
             raise ValidationError("Step name missing")
         if len(value) > MAX_NAME_LEN:
             raise ValidationError("Step name too long")
-        if INVALID_NAME_CHECK.search(value):
+        if not INVALID_NAME_CHARS.isdisjoint(value):
             raise ValidationError("Step name contains invalid characters")
 
 
@@ -77,7 +85,7 @@ class MetricsOptions(Schema):
     enabled = fields.Bool(missing=True)
     instance_type = fields.String(
         missing="c4.large",
-        validate=validate.OneOf(ec2_vcpu_by_type.keys())
+        validate=validate.OneOf(VALID_INSTANCE_TYPES)
     )
     dashboard = fields.Nested(DashboardOptions)
     tear_down = fields.Bool(missing=False)
@@ -87,6 +95,7 @@ class PlanValidator(Schema):
     ecs_name = fields.String(required=True)
     name = fields.String(required=True)
     metrics_options = fields.Nested(MetricsOptions, missing={})
+    max_workers = fields.Int(validate=validate.Range(min=1, max=MAX_WORKERS))
 
     steps = fields.Nested(StepValidator, many=True)
 
@@ -95,20 +104,13 @@ class PlanValidator(Schema):
             raise ValidationError("{} missing".format(name_type))
         if len(value) > MAX_NAME_LEN:
             raise ValidationError("{} too long".format(name_type))
-        if INVALID_NAME_CHECK.search(value):
+        if not INVALID_NAME_CHARS.isdisjoint(value):
             raise ValidationError(
                 "{} contained invalid characters".format(name_type))
 
     @decorators.validates("ecs_name")
     def validate_ecs_name(self, value):
-        """Verify a cluster exists for this name"""
         self._log_validate_name(value, "Plan ecs_name")
-        client = self.context["boto"].client('ecs')
-        response = client.describe_clusters(
-            clusters=[value]
-        )
-        if not response.get("clusters"):
-            raise ValidationError("No cluster with the provided name.")
 
     @decorators.validates("name")
     def validate_name(self, value):
@@ -126,9 +128,12 @@ class AsynchronousPlanRunner(object):
     # For testing purposes
     boto = boto3
 
+    # S3 clients shared across runners, keyed by the boto module
+    _s3 = {}  # type: Dict[Any, Any]
+
     def __init__(self, event, context):
-        logger.info("Called with {}".format(event))
-        logger.info("Environ: {}".format(os.environ))
+        logger.debug("Called with %s", event)
+        logger.debug("Environ: %s", os.environ)
 
         # Load our TOML if needed
         event = self._load_toml(event)
@@ -137,22 +142,23 @@ class AsynchronousPlanRunner(object):
         self.context = context
         self.ecs = ECSManager(plan=event)
 
+    @property
+    def s3_client(self):
+        if self.boto not in self._s3:
+            self._s3[self.boto] = self.boto.client('s3', config=S3_CONFIG)
+        return self._s3[self.boto]
+
     @property
     def grafana_auth(self):
-        if not self.event["metrics_options"].get("dashboard"):
+        dash_opts = self.event["metrics_options"].get("dashboard")
+        if not dash_opts:
             return "", ""
-
-        dash_opts = self.event["metrics_options"]["dashboard"]
         return dash_opts["admin_user"], dash_opts["admin_password"]
 
-    @property
-    def dashboard_options(self):
-        return self.event["metrics_options"]["dashboard"]
-
     def _build_instance_map(self):
         """Given a JSON test-plan, build and return a dict of instance types
         and how many should exist for each type."""
-        instances = defaultdict(int)
+        instances = Counter()
         for step in self.event["steps"]:
             instances[step["instance_type"]] += step["instance_count"]
         return instances
@@ -162,18 +168,23 @@ class AsynchronousPlanRunner(object):
         """Locates and calculates the longest test plan duration from its
         delay through its duration of the plan."""
         return max(
-            [x.get("run_delay", 0) + x["run_max_time"] for x in
-             self.event["steps"]]
+            x.get("run_delay", 0) + x["run_max_time"] for x in
+            self.event["steps"]
         )
 
     def _load_toml(self, event):
         """Loads TOML if necessary"""
-        return toml.loads(event["toml"]) if "toml" in event else event
+        if "toml" not in event:
+            return event
+
+        # Only the first step is handed TOML, so the other handlers don't
+        # pay for the import
+        import toml
+        return toml.loads(event["toml"])
 
     def _validate_plan(self):
         """Validates that the loaded plan is correct"""
         schema = PlanValidator()
-        schema.context["boto"] = self.boto
         data, errors = schema.load(self.event)
         if errors:
             raise ValidationException("Failed to validate: {}".format(errors))
@@ -189,12 +200,20 @@ class AsynchronousPlanRunner(object):
         # First, validate the test plan, done only as part of step 1
         self._validate_plan()
 
+        # Describe the cluster's instances while checking the cluster
+        # exists, the metrics node check is answered from the same query
+        cluster_check = self.ecs.start_cluster_check()
+        current_instances = self.ecs.query_active_instances()
+        if not cluster_check.result():
+            raise ValidationException("No cluster with the provided name.")
+
         needed = self._build_instance_map()
 
         # Ensure we have the metrics instance
-        if self.event["metrics_options"]["enabled"]:
+        metrics_options = self.event["metrics_options"]
+        if metrics_options["enabled"]:
             # Query to see if we need to add a metrics node
-            metric_inst_type = self.event["metrics_options"]["instance_type"]
+            metric_inst_type = metrics_options["instance_type"]
 
             # We add the instance type to needed to ensure we don't leave out
             # more nodes since this will turn up in the query_active results
@@ -209,14 +228,15 @@ class AsynchronousPlanRunner(object):
                                         os.environ["ec2_sg"]],
                     additional_tags={"Role": "metrics"}
                 )
+                # Count the new node rather than describing the cluster again
+                current_instances[metric_inst_type] += 1
 
-        logger.info("Plan instances needed: {}".format(needed))
-        current_instances = self.ecs.query_active_instances()
+        logger.info("Plan instances needed: %s", needed)
         missing_instances = self.ecs.calculate_missing_instances(
             desired=needed, current=current_instances
         )
         if missing_instances:
-            logger.info("Requesting instances: {}".format(missing_instances))
+            logger.info("Requesting instances: %s", missing_instances)
             self.ecs.request_instances(
                 instances=missing_instances,
                 security_group_ids=[os.environ["ec2_sg"]]
@@ -227,7 +247,8 @@ class AsynchronousPlanRunner(object):
         """Start the metrics service, ensure its running, and its IP is known
 
         """
-        if not self.event["metrics_options"]["enabled"]:
+        metrics_options = self.event["metrics_options"]
+        if not metrics_options["enabled"]:
             return self.event
 
         # Is the service already running?
@@ -236,7 +257,7 @@ class AsynchronousPlanRunner(object):
 
         if not metrics:
             # Start the metrics service, throw a retry
-            self.ecs.create_metrics_service(self.event["metrics_options"])
+            self.ecs.create_metrics_service(metrics_options)
             raise ServicesStartingException("Triggered metrics start")
 
         deploy = metrics["deployments"][0]
@@ -258,16 +279,19 @@ class AsynchronousPlanRunner(object):
 
     def ensure_metric_sources_created(self):
         """Ensure the metrics db and grafana datasource are configured"""
-        if not self.event["metrics_options"]["enabled"]:
+        metrics_options = self.event["metrics_options"]
+        if not metrics_options["enabled"]:
             return self.event
 
-        if not self.ecs.has_started_metric_creation():
+        started, finished = self.ecs.metric_creation_state()
+        if not started:
             dashboard = None
             dashboard_name = None
-            if self.event["metrics_options"].get("dashboard"):
+            dashboard_options = metrics_options.get("dashboard")
+            if dashboard_options:
                 dashboard = ":".join([os.environ["metrics_bucket"],
-                                      self.dashboard_options["filename"]])
-                dashboard_name = self.dashboard_options["name"]
+                                      dashboard_options["filename"]])
+                dashboard_name = dashboard_options["name"]
             self.ecs.run_metric_creation_task(
                 container_instance=self.event["metric_container_arn"],
                 grafana_auth=self.grafana_auth,
@@ -276,7 +300,7 @@ class AsynchronousPlanRunner(object):
             )
             raise CreatingMetricSourceException("Started metric creation")
 
-        if not self.ecs.has_finished_metric_creation():
+        if not finished:
             raise CreatingMetricSourceException("Metric creation still "
                                                 "running")
 
@@ -303,14 +327,15 @@ class AsynchronousPlanRunner(object):
         """Drop a ready file in S3 to trigger the test plan to being
 
         """
-        s3_client = self.boto.client('s3')
-        s3_client.put_object(
+        start_time = str(int(time.time()))
+        self.s3_client.put_object(
             ACL="public-read",
-            Body=b'{}'.format(int(time.time())),
-            Bucket=os.environ["s3_ready_bucket"],
-            Key="{}.ready".format(self.ecs.plan_uuid),
+            Body=start_time.encode("ascii"),
+            Bucket=self.ecs.s3_ready_bucket,
+            Key=self.ecs.s3_ready_key,
             Metadata={
-                "ECSCluster": self.event["ecs_name"]
+                "ECSCluster": self.event["ecs_name"],
+                "StartTime": start_time
             }
         )
         return self.event
@@ -320,19 +345,30 @@ class AsynchronousPlanRunner(object):
         specified duration
 
         """
-        # Check to see if the S3 file is still around
-        s3 = self.boto.resource('s3')
+        # Check to see if the S3 file is still around, its start time is
+        # normally in the metadata so the body isn't needed
         try:
-            ready_file = s3.Object(
-                os.environ["s3_ready_bucket"],
-                "{}.ready".format(self.ecs.plan_uuid)
+            response = self.s3_client.head_object(
+                Bucket=self.ecs.s3_ready_bucket,
+                Key=self.ecs.s3_ready_key
             )
-        except botocore.exceptions.ClientError:
+
+            # S3 returns user metadata keys lower-cased. Ready files written
+            # by older releases only carry the start time in their body.
+            start_time = response.get("Metadata", {}).get("starttime")
+            if start_time is None:
+                ready_file = self.s3_client.get_object(
+                    Bucket=self.ecs.s3_ready_bucket,
+                    Key=self.ecs.s3_ready_key
+                )
+                start_time = ready_file["Body"].read().decode('utf-8')
+        except botocore.exceptions.ClientError as exc:
+            if exc.response["Error"].get("Code") in ("404", "NoSuchKey"):
+                raise ReadyFileMissingException("Ready file not found")
             # Error getting to the bucket/key, abort test run
             raise ShutdownPlanException("Error accessing ready file")
 
-        file_contents = ready_file.get()['Body'].read().decode('utf-8')
-        start_time = int(file_contents)
+        start_time = int(start_time)
 
         # Update to running count 0 any services that should halt by now
         self.ecs.stop_finished_services(start_time, self.event["steps"])
@@ -346,19 +382,24 @@ class AsynchronousPlanRunner(object):
 
     def cleanup_cluster(self):
         """Shutdown all ECS services and deregister all task definitions"""
-        self.ecs.shutdown_plan(self.event["steps"])
+        # The ready file doesn't depend on the services, so remove it on
+        # the manager's shared thread pool while the plan is shut down
+        deleted = self.ecs._executor.submit(self._delete_ready_file)
+        try:
+            self.ecs.shutdown_plan(self.event["steps"])
+        finally:
+            deleted.result()
+        return self.event
 
-        # Attempt to remove the S3 object
-        s3 = self.boto.resource('s3')
+    def _delete_ready_file(self):
+        """Attempt to remove the S3 ready file"""
         try:
-            ready_file = s3.Object(
-                os.environ["s3_ready_bucket"],
-                "{}.ready".format(self.ecs.plan_uuid)
+            self.s3_client.delete_object(
+                Bucket=self.ecs.s3_ready_bucket,
+                Key=self.ecs.s3_ready_key
             )
-            ready_file.delete()
         except botocore.exceptions.ClientError:
             pass
-        return self.event
 
     def check_drained(self):
         """Ensure that all services are shut down before allowing restart"""
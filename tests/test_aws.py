@@ -3,20 +3,48 @@ import os
 import time
 import unittest
 
+import jmespath
 import mock
+from botocore.exceptions import ClientError
 from nose.tools import assert_raises, eq_, ok_
 
 from tests import fixtures
 
 
+def mock_page_iterator(pages):
+    """Mock a botocore PageIterator over pages, including search"""
+    def search(expression):
+        for page in pages:
+            for result in jmespath.search(expression, page) or []:
+                yield result
+
+    page_iterator = mock.MagicMock()
+    page_iterator.__iter__.side_effect = lambda: iter(pages)
+    page_iterator.search.side_effect = search
+    return page_iterator
+
+
 class TestECSManager(unittest.TestCase):
-    def _make_FUT(self, plan=None):
+    def setUp(self):
+        self._env = mock.patch.dict(os.environ, {
+            "s3_ready_bucket": "test_bucket",
+            "ecs_profile": "arn:something:fantastic:::",
+            "container_log_group": "ardere",
+        })
+        self._env.start()
+
         from ardere.aws import ECSManager
-        os.environ["s3_ready_bucket"] = "test_bucket"
-        os.environ["ecs_profile"] = "arn:something:fantastic:::"
-        os.environ["container_log_group"] = "ardere"
         self.boto_mock = mock.Mock()
-        ECSManager.boto = self.boto_mock
+        self._boto_patcher = mock.patch.object(ECSManager, "boto",
+                                               self.boto_mock)
+        self._boto_patcher.start()
+
+    def tearDown(self):
+        self._boto_patcher.stop()
+        self._env.stop()
+
+    def _make_FUT(self, plan=None):
+        from ardere.aws import ECSManager
         if not plan:
             plan = json.loads(fixtures.sample_basic_test_plan)
             plan["metrics_options"] = dict(
@@ -33,15 +61,61 @@ class TestECSManager(unittest.TestCase):
         eq_(ecs._plan["plan_run_uuid"], ecs._plan_uuid)
         eq_(ecs.plan_uuid, ecs._plan_uuid)
 
+    def test_init_max_workers(self):
+        ecs = self._make_FUT()
+        eq_(ecs._max_workers, 32)
+        _, kwargs = ecs.boto.client.call_args
+        eq_(kwargs["config"].max_pool_connections, 32)
+        eq_(kwargs["config"].retries["mode"], "adaptive")
+
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["max_workers"] = 4
+        ecs = self._make_FUT(plan)
+        eq_(ecs._max_workers, 4)
+        _, kwargs = ecs.boto.client.call_args
+        eq_(kwargs["config"].max_pool_connections, 4)
+
+        # Values validation would reject are bounded
+        plan["max_workers"] = 1000
+        eq_(self._make_FUT(plan)._max_workers, 64)
+        plan["max_workers"] = -2
+        eq_(self._make_FUT(plan)._max_workers, 1)
+        plan["max_workers"] = "many"
+        eq_(self._make_FUT(plan)._max_workers, 32)
+
+    def test_clients_shared(self):
+        ecs = self._make_FUT()
+        from ardere.aws import ECSManager
+        other = ECSManager(json.loads(fixtures.sample_basic_test_plan))
+        ok_(other._ecs_client is ecs._ecs_client)
+        ok_(other._ec2_client is ecs._ec2_client)
+        eq_(ecs.boto.client.call_count, 2)
+
+    def test_executor_shared(self):
+        ecs = self._make_FUT()
+        eq_(ecs._executor._max_workers, 32)
+        ok_(ecs._executor is ecs._executor)
+
+        from ardere.aws import ECSManager
+        other = ECSManager(json.loads(fixtures.sample_basic_test_plan))
+        ok_(other._executor is ecs._executor)
+
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["max_workers"] = 4
+        small = self._make_FUT(plan)
+        eq_(small._executor._max_workers, 4)
+
     def test_ready_file(self):
         ecs = self._make_FUT()
         ready_filename = ecs.s3_ready_file
         ok_("test_bucket" in ready_filename)
         ok_(ecs._plan_uuid in ready_filename)
+        eq_(ecs.s3_ready_key, "{}.ready".format(ecs._plan_uuid))
+        ok_(ready_filename.endswith("/" + ecs.s3_ready_key))
 
     def test_query_active(self):
         mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
+        mock_paginator.paginate.return_value = mock_page_iterator([
             {"Reservations": [
                 {
                     "Instances": [
@@ -54,13 +128,81 @@ class TestECSManager(unittest.TestCase):
                     ]
                 }
             ]}
-        ]
+        ])
 
         ecs = self._make_FUT()
         ecs._ec2_client.get_paginator.return_value = mock_paginator
         instance_dct = ecs.query_active_instances()
         eq_(len(instance_dct.values()), 1)
 
+    def test_query_active_counts(self):
+        def instance(code, instance_type="t2.medium", **tags):
+            return {"State": {"Code": code}, "InstanceType": instance_type,
+                    "Tags": [dict(Key=key, Value=value)
+                             for key, value in tags.items()]}
+
+        mock_paginator = mock.Mock()
+        mock_paginator.paginate.return_value = mock_page_iterator([
+            {"Reservations": [
+                {"Instances": [instance(16), instance(0)]},
+                {"Instances": [instance(16, "c4.large", Role="metrics")]}
+            ]},
+            {"Reservations": [
+                {"Instances": [instance(16, "c4.large")]}
+            ]}
+        ])
+
+        ecs = self._make_FUT()
+        ecs._ec2_client.get_paginator.return_value = mock_paginator
+        eq_(ecs.query_active_instances(), {"t2.medium": 2, "c4.large": 2})
+        eq_(ecs.query_active_instances(additional_tags=dict(Role="metrics")),
+            {"c4.large": 1})
+        eq_(ecs.query_active_instances(additional_tags=dict(Role="other")),
+            {})
+
+        # Only pending/running instances are requested from EC2
+        _, kwargs = mock_paginator.paginate.call_args
+        ok_({"Name": "instance-state-name",
+             "Values": ["pending", "running"]} in kwargs["Filters"])
+
+    def test_query_active_cached(self):
+        mock_paginator = mock.Mock()
+        mock_paginator.paginate.return_value = mock_page_iterator([
+            {"Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "State": {
+                                "Code": 16
+                            },
+                            "InstanceType": "t2.medium"
+                        }
+                    ]
+                }
+            ]}
+        ])
+
+        ecs = self._make_FUT()
+        ecs._ec2_client.get_paginator.return_value = mock_paginator
+        first = ecs.query_active_instances()
+        eq_(ecs.query_active_instances(), first)
+        eq_(mock_paginator.paginate.call_count, 1)
+
+        # Queries with different tags share the described instances
+        ecs.query_active_instances(additional_tags=dict(Role="metrics"))
+        eq_(mock_paginator.paginate.call_count, 1)
+
+        # Expired entries are queried again
+        later = time.time() + 60
+        with mock.patch("ardere.aws.time.time", return_value=later):
+            ecs.query_active_instances()
+        eq_(mock_paginator.paginate.call_count, 2)
+
+        # Requesting instances drops the cache
+        ecs.request_instances({"t2.medium": 1}, ["i-382842"])
+        ecs.query_active_instances()
+        eq_(mock_paginator.paginate.call_count, 3)
+
     def test_calculate_missing_instances(self):
         ecs = self._make_FUT()
         result = ecs.calculate_missing_instances(
@@ -68,9 +210,35 @@ class TestECSManager(unittest.TestCase):
         )
         eq_(result, {"t2.medium": 1})
 
+        result = ecs.calculate_missing_instances(
+            desired={"t2.medium": 2, "c4.large": 1, "m4.large": 3},
+            current={"t2.medium": 4, "c4.large": 1, "r4.large": 2}
+        )
+        eq_(result, {"m4.large": 3})
+
+    def test_start_cluster_check(self):
+        ecs = self._make_FUT()
+        ecs._ecs_client.describe_clusters.return_value = {"clusters": []}
+        eq_(ecs.start_cluster_check().result(), False)
+
+        ecs._ecs_client.describe_clusters.return_value = {
+            "clusters": [{"clusterName": "ardere-test"}]
+        }
+        ok_(ecs.start_cluster_check().result())
+        ecs._ecs_client.describe_clusters.assert_called_with(
+            clusters=[ecs._ecs_name])
+
+        # A cluster that exists is remembered until the TTL passes
+        ok_(ecs.start_cluster_check().result())
+        eq_(ecs._ecs_client.describe_clusters.call_count, 2)
+        with mock.patch("ardere.aws.time.time",
+                        return_value=time.time() + 601):
+            ok_(ecs.start_cluster_check().result())
+        eq_(ecs._ecs_client.describe_clusters.call_count, 3)
+
     def test_has_metrics_node(self):
         mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
+        mock_paginator.paginate.return_value = mock_page_iterator([
             {"Reservations": [
                 {
                     "Instances": [
@@ -78,27 +246,42 @@ class TestECSManager(unittest.TestCase):
                             "State": {
                                 "Code": 16
                             },
-                            "InstanceType": "t2.medium"
+                            "InstanceType": "t2.medium",
+                            "Tags": [{"Key": "Role", "Value": "metrics"}]
                         }
                     ]
                 }
             ]}
-        ]
+        ])
 
         ecs = self._make_FUT()
         ecs._ec2_client.get_paginator.return_value = mock_paginator
         resp = ecs.has_metrics_node("t2.medium")
         eq_(resp, True)
+        eq_(ecs.has_metrics_node("c4.large"), False)
 
-    def test_has_started_metric_creation(self):
+        # The plan wide query reuses the same DescribeInstances results
+        eq_(ecs.query_active_instances(), {"t2.medium": 1})
+        eq_(mock_paginator.paginate.call_count, 1)
+
+    def test_metric_creation_state_finished(self):
         ecs = self._make_FUT()
         ecs._ecs_client.list_tasks.return_value = {"taskArns": [123]}
-        eq_(ecs.has_started_metric_creation(), True)
+        eq_(ecs.metric_creation_state(), (True, True))
+        eq_(ecs._ecs_client.list_tasks.call_count, 1)
 
-    def test_has_finished_metric_creation(self):
+    def test_metric_creation_state_running(self):
         ecs = self._make_FUT()
-        ecs._ecs_client.list_tasks.return_value = {"taskArns": [123]}
-        eq_(ecs.has_finished_metric_creation(), True)
+        ecs._ecs_client.list_tasks.side_effect = [
+            {"taskArns": []},
+            {"taskArns": [123]}
+        ]
+        eq_(ecs.metric_creation_state(), (True, False))
+
+    def test_metric_creation_state_not_started(self):
+        ecs = self._make_FUT()
+        ecs._ecs_client.list_tasks.return_value = {"taskArns": []}
+        eq_(ecs.metric_creation_state(), (False, False))
 
     def test_request_instances(self):
         instances = {
@@ -111,6 +294,30 @@ class TestECSManager(unittest.TestCase):
         ecs.request_instances(instances, ["i-382842"], {"Role": "metrics"})
         ecs._ec2_client.run_instances.assert_called()
 
+        # Tags are applied at launch, not with a separate create_tags call
+        _, kwargs = ecs._ec2_client.run_instances.call_args
+        tag_spec = kwargs["TagSpecifications"][0]
+        eq_(tag_spec["ResourceType"], "instance")
+        tags = {t["Key"]: t["Value"] for t in tag_spec["Tags"]}
+        eq_(tags["Owner"], "ardere")
+        eq_(tags["ECSCluster"], ecs._ecs_name)
+        eq_(tags["Role"], "metrics")
+        ecs._ec2_client.create_tags.assert_not_called()
+
+    def test_request_instances_multiple_types(self):
+        instances = {
+            "t2.medium": 10,
+            "c4.large": 2
+        }
+        ecs = self._make_FUT()
+        # Create the mock up front, the worker threads would race to
+        # create it and one of them could record its call on a lost copy
+        ecs._ec2_client.run_instances = mock.Mock()
+        ecs.request_instances(instances, ["i-382842"])
+        eq_(sorted((kwargs["InstanceType"], kwargs["MinCount"]) for _, kwargs
+                   in ecs._ec2_client.run_instances.call_args_list),
+            [("c4.large", 2), ("t2.medium", 10)])
+
     def test_locate_metrics_container_ip(self):
         ecs = self._make_FUT()
         ecs._ecs_client.list_container_instances.return_value = {
@@ -121,10 +328,16 @@ class TestECSManager(unittest.TestCase):
                 {"ec2InstanceId": "e-28193823"}
             ]
         }
-        mock_resource = mock.Mock()
-        ecs.boto.resource.return_value = mock_resource
-        ecs.locate_metrics_container_ip()
-        ecs.boto.resource.assert_called()
+        ecs._ec2_client.describe_instances.return_value = {
+            "Reservations": [
+                {"Instances": [{"PrivateIpAddress": "10.0.0.5"}]}
+            ]
+        }
+        result = ecs.locate_metrics_container_ip()
+        eq_(result, ("10.0.0.5", "arn:of:some:container::"))
+        ecs._ec2_client.describe_instances.assert_called_with(
+            InstanceIds=["e-28193823"])
+        ecs.boto.resource.assert_not_called()
 
     def test_locate_metrics_container_ip_not_found(self):
         ecs = self._make_FUT()
@@ -204,32 +417,87 @@ class TestECSManager(unittest.TestCase):
         container_def = kwargs["containerDefinitions"][0]
         ok_("portMappings" in container_def)
 
+        # The wait script is passed as is and run before the step command
+        env = {e["name"]: e["value"] for e in container_def["environment"]}
+        eq_(env["__ARDERE_WAITFORCLUSTER_SH__"], ecs.wait_script)
+        ok_(container_def["entryPoint"][2].startswith(
+            'sh -c "$__ARDERE_WAITFORCLUSTER_SH__" waitforcluster.sh '))
+
+        # Telegraf gets the shared settings plus the step's own
+        telegraf_def = kwargs["containerDefinitions"][1]
+        env = {e["name"]: e["value"] for e in telegraf_def["environment"]}
+        eq_(env["__ARDERE_INFLUX_ADDR__"], "1.1.1.1:8086")
+        eq_(env["__ARDERE_TELEGRAF_STEP__"], step["name"])
+        eq_(env["__ARDERE_TELEGRAF_TYPE__"], "default")
+        eq_(len(ecs._base_telegraf_def["environment"]), 3)
+
     def test_create_services(self):
         ecs = self._make_FUT()
-        ecs.create_service = mock.Mock()
-        ecs.create_services(ecs._plan["steps"])
-        ecs.create_service.assert_called()
+        steps = ecs._plan["steps"]
+        ecs._register_task = mock.Mock()
+        ecs._create_service_for_task = mock.Mock()
+        ecs.create_services(steps)
+        eq_(ecs._register_task.call_count, len(steps))
+        eq_(ecs._create_service_for_task.call_count, len(steps))
+
+    def test_create_services_registers_tasks_first(self):
+        ecs = self._make_FUT()
+        steps = ecs._plan["steps"]
+        calls = []
+        ecs._register_task = mock.Mock(
+            side_effect=lambda step: calls.append("register"))
+        ecs._create_service_for_task = mock.Mock(
+            side_effect=lambda step: calls.append("create"))
+        ecs.create_services(steps)
+        eq_(calls, ["register"] * len(steps) + ["create"] * len(steps))
 
     def test_create_services_ecs_error(self):
-        from botocore.exceptions import ClientError
         ecs = self._make_FUT()
 
-        step = ecs._plan["steps"][0]
+        steps = ecs._plan["steps"]
         ecs._plan["influxdb_private_ip"] = "1.1.1.1"
-        step["docker_series"] = "default"
+        for step in steps:
+            step["docker_series"] = "default"
         ecs._ecs_client.register_task_definition.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
-        with assert_raises(ClientError):
-            ecs.create_services(ecs._plan["steps"])
+        with mock.patch("ardere.aws.logger") as mock_logger:
+            with assert_raises(ClientError):
+                ecs.create_services(steps)
+
+        # Every step was attempted, but no services were created
+        eq_(ecs._ecs_client.register_task_definition.call_count, len(steps))
+        ecs._ecs_client.create_service.assert_not_called()
+
+        # Each failure is logged with its traceback
+        eq_(mock_logger.error.call_count, len(steps))
+        _, kwargs = mock_logger.error.call_args
+        exc_type, exc, tb = kwargs["exc_info"]
+        eq_(exc_type, ClientError)
+        ok_(tb is not None)
 
-    def test_service_ready_true(self):
+    def test_describe_services(self):
+        ecs = self._make_FUT()
+        names = ["step-{}".format(i) for i in range(25)]
+
+        def describe_services(cluster, services):
+            return {"services": [{"serviceName": name} for name in services]}
+        ecs._ecs_client.describe_services.side_effect = describe_services
+
+        result = ecs.describe_services(names)
+        eq_(sorted(result.keys()), sorted(names))
+        eq_(sorted([len(kwargs["services"]) for _, kwargs in
+                    ecs._ecs_client.describe_services.call_args_list]),
+            [5, 10, 10])
+
+    def test_all_services_ready(self):
         ecs = self._make_FUT()
         step = ecs._plan["steps"][0]
 
         ecs._ecs_client.describe_services.return_value = {
             "services": [{
+                "serviceName": step["name"],
                 "deployments": [{
                     "desiredCount": 2,
                     "runningCount": 2
@@ -237,180 +505,250 @@ class TestECSManager(unittest.TestCase):
             }]
         }
 
-        result = ecs.service_ready(step)
+        result = ecs.all_services_ready(ecs._plan["steps"])
         eq_(result, True)
 
-    def test_service_not_known_yet(self):
+    def test_all_services_ready_still_starting(self):
         ecs = self._make_FUT()
         step = ecs._plan["steps"][0]
 
         ecs._ecs_client.describe_services.return_value = {
-            "services": []
+            "services": [{
+                "serviceName": step["name"],
+                "deployments": [{
+                    "desiredCount": 2,
+                    "runningCount": 1
+                }]
+            }]
         }
 
-        result = ecs.service_ready(step)
+        result = ecs.all_services_ready(ecs._plan["steps"])
         eq_(result, False)
 
-    def test_all_services_ready(self):
+    def test_all_services_ready_not_known_yet(self):
         ecs = self._make_FUT()
-        ecs.service_ready = mock.Mock()
-
-        ecs.all_services_ready(ecs._plan["steps"])
-        ecs.service_ready.assert_called()
-
-    def test_service_done_true(self):
-        ecs = self._make_FUT()
-        step = ecs._plan["steps"][0]
 
         ecs._ecs_client.describe_services.return_value = {
-            "services": [{
-                "status": "INACTIVE"
-            }]
+            "services": []
         }
 
-        result = ecs.service_done(step)
-        eq_(result, True)
+        result = ecs.all_services_ready(ecs._plan["steps"])
+        eq_(result, False)
 
-    def test_service_not_known(self):
+    def test_all_services_ready_throttled(self):
         ecs = self._make_FUT()
-        step = ecs._plan["steps"][0]
+        ecs._ecs_client.describe_services.side_effect = ClientError(
+            {"Error": {"Code": "ThrottlingException"}}, "op"
+        )
+        eq_(ecs.all_services_ready(ecs._plan["steps"]), False)
 
-        ecs._ecs_client.describe_services.return_value = {
-            "services": [{
-                "status": "DRAINING"
-            }]
-        }
+    def test_all_services_ready_error(self):
+        ecs = self._make_FUT()
+        ecs._ecs_client.describe_services.side_effect = ClientError(
+            {"Error": {"Code": "AccessDeniedException"}}, "op"
+        )
 
-        result = ecs.service_done(step)
-        eq_(result, False)
+        with assert_raises(ClientError):
+            ecs.all_services_ready(ecs._plan["steps"])
 
     def test_all_services_done(self):
         ecs = self._make_FUT()
-        ecs.service_done = mock.Mock()
-        ecs.all_services_done(ecs._plan["steps"])
-        ecs.service_done.assert_called()
+        names = ["step-{}".format(i) for i in range(25)]
+        steps = [dict(name=name) for name in names]
 
-    def test_stop_finished_service_stopped(self):
-        ecs = self._make_FUT()
-        ecs._ecs_client.update_service = mock.Mock()
-        step = ecs._plan["steps"][0]
-        step["service_status"] = "STARTED"
-        past = time.time() - 400
-        ecs.stop_finished_service(past, step)
-        ecs._ecs_client.update_service.assert_called()
-        eq_(step["service_status"], "STOPPED")
+        def describe_services(cluster, services):
+            # Drop the first service, as if it was already deleted
+            return {"services": [
+                {"serviceName": name, "status": "INACTIVE"}
+                for name in services if name != "step-0"
+            ]}
+        ecs._ecs_client.describe_services.side_effect = describe_services
 
-    def test_stop_finished_service_stop_already_stopped(self):
-        ecs = self._make_FUT()
-        ecs._ecs_client.update_service = mock.Mock()
-        step = ecs._plan["steps"][0]
-        step["service_status"] = "STOPPED"
-        past = time.time() - 400
-        ecs.stop_finished_service(past, step)
-        ecs._ecs_client.update_service.assert_not_called()
-        eq_(step["service_status"], "STOPPED")
+        eq_(ecs.all_services_done(steps), True)
+        eq_(ecs._ecs_client.describe_services.call_count, 3)
 
-    def test_stop_finished_service_still_running(self):
+        def describe_draining(cluster, services):
+            return {"services": [
+                {"serviceName": name,
+                 "status": "DRAINING" if name == "step-24" else "INACTIVE"}
+                for name in services
+            ]}
+        ecs._ecs_client.describe_services.side_effect = describe_draining
+        eq_(ecs.all_services_done(steps), False)
+
+    def test_stop_finished_services(self):
         ecs = self._make_FUT()
+        # Create the mock up front, the worker threads would race to
+        # create it and one of them could record its call on a lost copy
         ecs._ecs_client.update_service = mock.Mock()
         step = ecs._plan["steps"][0]
-        step["service_status"] = "STARTED"
-        past = time.time() - 100
-        ecs.stop_finished_service(past, step)
-        ecs._ecs_client.update_service.assert_not_called()
-        eq_(step["service_status"], "STARTED")
+        steps = [
+            dict(step, name="done", service_status="STARTED"),
+            dict(step, name="stopped", service_status="STOPPED"),
+            dict(step, name="running", service_status="STARTED",
+                 run_delay=300),
+            dict(step, name="also-done", service_status="STARTED",
+                 run_max_time=10),
+        ]
 
-    def test_stop_finished_services(self):
-        ecs = self._make_FUT()
-        ecs.stop_finished_service = mock.Mock()
+        past = time.time() - 200
+        ecs.stop_finished_services(past, steps)
+        eq_(sorted(kwargs["service"] for _, kwargs in
+                   ecs._ecs_client.update_service.call_args_list),
+            ["also-done", "done"])
+        eq_([s["service_status"] for s in steps],
+            ["STOPPED", "STOPPED", "STARTED", "STOPPED"])
+
+        # Nothing else is due yet
+        ecs.stop_finished_services(past, steps)
+        eq_(ecs._ecs_client.update_service.call_count, 2)
+
+    def _mock_shutdown_paginators(self, ecs, task_arns=None):
+        pages = {
+            "list_services": [
+                {"serviceArns": ["arn:123:::", "arn:456:::"]}
+            ],
+            "list_task_definitions": [
+                {"taskDefinitionArns": task_arns or [
+                    "arn:task:::task-definition/{}:1".format(
+                        ecs.family_name(step))
+                    for step in ecs._plan["steps"]
+                ]}
+            ]
+        }
 
-        past = time.time() - 100
-        ecs.stop_finished_services(past, ecs._plan["steps"])
-        ecs.stop_finished_service.assert_called()
+        self.paginators = {}
 
-    def test_shutdown_plan(self):
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
+        def get_paginator(name):
+            mock_paginator = mock.Mock()
+            mock_paginator.paginate.return_value = pages[name]
+            self.paginators[name] = mock_paginator
+            return mock_paginator
+        ecs._ecs_client.get_paginator.side_effect = get_paginator
+
+    def test_task_definition_family(self):
+        from ardere.aws import task_definition_family
+        eq_(task_definition_family(
+            "arn:aws:ecs:us-east-1:012345678910:task-definition/"
+            "TestCluster-2ef8a-b52c:3"),
+            "TestCluster-2ef8a-b52c")
+
+    def test_read_script(self):
+        from ardere.aws import read_script, wait_script_path
+        ecs = self._make_FUT()
+        script = ecs.wait_script
+        with mock.patch("ardere.aws.open", create=True) as mock_open:
+            eq_(read_script(wait_script_path), script)
+            eq_(mock_open.call_count, 0)
 
+    def test_shutdown_plan(self):
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._mock_shutdown_paginators(ecs)
 
         ecs.shutdown_plan(ecs._plan["steps"])
-        ecs._ecs_client.deregister_task_definition.assert_called()
-        ecs._ecs_client.delete_service.assert_called()
-
-    def test_shutdown_plan_update_error(self):
-        from botocore.exceptions import ClientError
+        ecs._ecs_client.deregister_task_definition.assert_called_with(
+            taskDefinition="arn:task:::task-definition/{}:1".format(
+                ecs.family_name(ecs._plan["steps"][0]))
+        )
+        ecs._ecs_client.delete_service.assert_called_with(
+            cluster=ecs._ecs_name, service="arn:123:::"
+        )
+        self.paginators["list_services"].paginate.assert_called_with(
+            cluster=ecs._ecs_name,
+            PaginationConfig={"PageSize": 100}
+        )
+        self.paginators["list_task_definitions"].paginate.assert_called_with(
+            familyPrefix=ecs.family_name(ecs._plan["steps"][0]),
+            status="ACTIVE",
+            PaginationConfig={"PageSize": 100}
+        )
 
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
+    def test_shutdown_plan_recorded_task_arns(self):
+        ecs = self._make_FUT()
+        ecs.locate_metrics_service = mock.Mock()
+        ecs.locate_metrics_service.return_value = None
+        self._mock_shutdown_paginators(ecs)
+        steps = ecs._plan["steps"]
+        for index, step in enumerate(steps):
+            step["taskArn"] = "arn:task:::task-definition/{}:{}".format(
+                ecs.family_name(step), index + 1)
+        ecs._ecs_client.deregister_task_definition = mock.Mock()
+
+        ecs.shutdown_plan(steps)
+        ok_("list_task_definitions" not in self.paginators)
+        eq_(sorted(kwargs["taskDefinition"] for _, kwargs in
+                   ecs._ecs_client.deregister_task_definition.call_args_list),
+            sorted(step["taskArn"] for step in steps))
+
+    def test_shutdown_plan_list_task_definitions_error(self):
+        ecs = self._make_FUT()
+        ecs._plan["metrics_options"]["tear_down"] = True
+        steps = ecs._plan["steps"]
+        steps[0]["taskArn"] = "arn:task:::task-definition/{}:1".format(
+            ecs.family_name(steps[0]))
+
+        # Listing the other families fails
+        paginators = {
+            "list_services": mock.Mock(),
+            "list_task_definitions": mock.Mock()
+        }
+        paginators["list_services"].paginate.return_value = [
+            {"serviceArns": []}
         ]
+        paginators["list_task_definitions"].paginate.side_effect = \
+            ClientError({"Error": {}}, "ListTaskDefinitions")
+        ecs._ecs_client.get_paginator.side_effect = paginators.get
+        ecs._ecs_client.deregister_task_definition = mock.Mock()
+
+        with mock.patch("ardere.aws.logger") as mock_logger:
+            ecs.shutdown_plan(steps)
 
+        # The recorded task definition is still deregistered
+        ecs._ecs_client.deregister_task_definition.assert_called_once_with(
+            taskDefinition=steps[0]["taskArn"])
+        mock_logger.warning.assert_called()
+
+    def test_shutdown_plan_update_error(self):
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._mock_shutdown_paginators(ecs)
         ecs._ecs_client.update_service.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
         ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.delete_service.assert_not_called()
+        ecs._ecs_client.deregister_task_definition.assert_called()
 
-    def test_shutdown_plan_describe_error(self):
-        from botocore.exceptions import ClientError
-
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
-
+    def test_shutdown_plan_other_task_definitions(self):
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._plan["steps"] = ecs._plan["steps"][:1]
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.side_effect = ClientError(
-            {"Error": {}}, "some_op"
-        )
+        self._mock_shutdown_paginators(ecs, task_arns=[
+            "arn:task:::task-definition/other-family:1",
+            "arn:task:::task-definition/{}:4".format(
+                ecs.metrics_family_name())
+        ])
 
         ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.deregister_task_definition.assert_not_called()
 
     def test_shutdown_plan_delete_error(self):
-        from botocore.exceptions import ClientError
-
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
-
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._mock_shutdown_paginators(ecs)
         ecs._ecs_client.delete_service.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
@@ -419,26 +757,20 @@ class TestECSManager(unittest.TestCase):
         ecs._ecs_client.delete_service.assert_called()
 
     def test_shutdown_plan_deregister_error(self):
-        from botocore.exceptions import ClientError
-
-        mock_paginator = mock.Mock()
-        mock_paginator.paginate.return_value = [
-            {"serviceArns": ["arn:123:::", "arn:456:::"]}
-        ]
-
         ecs = self._make_FUT()
         ecs.locate_metrics_service = mock.Mock()
         ecs.locate_metrics_service.return_value = dict(
             serviceArn="arn:456:::"
         )
         ecs._plan["metrics_options"]["tear_down"] = True
-        ecs._ecs_client.get_paginator.return_value = mock_paginator
-        ecs._ecs_client.describe_task_definition.return_value = {
-            "taskDefinition": {"taskDefinitionArn": "arn:task:::"}
-        }
+        self._mock_shutdown_paginators(ecs, task_arns=[
+            "arn:task:::task-definition/{}:4".format(
+                ecs.metrics_family_name())
+        ])
         ecs._ecs_client.deregister_task_definition.side_effect = ClientError(
             {"Error": {}}, "some_op"
         )
 
         ecs.shutdown_plan(ecs._plan["steps"])
         ecs._ecs_client.delete_service.assert_called()
+        ecs._ecs_client.deregister_task_definition.assert_called()
@@ -2,36 +2,57 @@ import os
 import unittest
 
 import mock
-from nose.tools import assert_raises, eq_
+from nose.tools import assert_raises, eq_, ok_
 
 
 class TestMetricRunner(unittest.TestCase):
+    def setUp(self):
+        self._env = mock.patch.dict(os.environ, {
+            "__ARDERE_INFLUXDB_NAME__": "ardere",
+        })
+        self._env.start()
+
+    def tearDown(self):
+        self._env.stop()
+
     def _make_FUT(self):
         from ardere.scripts.metric_creator import DashboardSetup
-        # Setup the env vars we need
-        os.environ["__ARDERE_INFLUXDB_NAME__"] = "ardere"
         return DashboardSetup()
 
     def test_load_dashboard(self):
         ds = self._make_FUT()
         mock_file = mock.Mock()
-        mock_file.get.return_value = {"Body": mock_file}
         mock_file.read.return_value = "{}".encode(
             'utf-8')
-        mock_s3_obj = mock.Mock()
-        mock_s3_obj.Object.return_value = mock_file
+        mock_s3_client = mock.Mock()
+        mock_s3_client.get_object.return_value = {"Body": mock_file}
 
         ds.boto = mock.Mock()
-        ds.boto.resource.return_value = mock_s3_obj
+        ds.boto.client.return_value = mock_s3_client
         ds.dashboard = "asdf:asdf"
         result = ds._load_dashboard()
         eq_(result, dict(id=None, title=None))
+        mock_s3_client.get_object.assert_called_with(Bucket="asdf",
+                                                     Key="asdf")
+
+    def test_session(self):
+        ds = self._make_FUT()
+        ds.req = mock.Mock()
+        session = ds.session
+        eq_(session.auth, ds.grafana_auth)
+        _, kwargs = ds.req.adapters.HTTPAdapter.call_args
+        ok_(kwargs["max_retries"].is_retry("POST", 503))
+        session.mount.assert_called_with(
+            "http://", ds.req.adapters.HTTPAdapter.return_value)
+        ok_(ds.session is session)
+        eq_(ds.req.Session.call_count, 1)
 
     def test_create_dashboard(self):
         ds = self._make_FUT()
         ds._load_dashboard = mock.Mock()
         ds.req = mock.Mock()
-        ds.req.post.return_value = mock.Mock(status_code=200)
+        ds.req.Session.return_value.post.return_value = mock.Mock(
+            status_code=200)
         ds._create_dashboard("http://localhost")
         ds._load_dashboard.assert_called()
 
@@ -39,7 +60,8 @@ class TestMetricRunner(unittest.TestCase):
         ds = self._make_FUT()
         ds._load_dashboard = mock.Mock()
         ds.req = mock.Mock()
-        ds.req.post.return_value = mock.Mock(status_code=500)
+        ds.req.Session.return_value.post.return_value = mock.Mock(
+            status_code=500)
         assert_raises(Exception, ds._create_dashboard, "http://localhost")
 
     def test_ensure_dashboard_create(self):
@@ -49,17 +71,30 @@ class TestMetricRunner(unittest.TestCase):
         mock_response.status_code = 200
         mock_response.json.return_value = []
         ds._create_dashboard = mock.Mock()
-        ds.req.get.return_value = mock_response
+        ds.req.Session.return_value.get.return_value = mock_response
 
         ds._ensure_dashboard("http://localhost")
         ds._create_dashboard.assert_called()
 
+    def test_ensure_dashboard_exists(self):
+        ds = self._make_FUT()
+        ds.dashboard_name = "ardere"
+        ds.req = mock.Mock()
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = [{"title": "ardere"}]
+        ds._create_dashboard = mock.Mock()
+        ds.req.Session.return_value.get.return_value = mock_response
+
+        ds._ensure_dashboard("http://localhost")
+        ds._create_dashboard.assert_not_called()
+
     def test_ensure_dashboard_exception(self):
         ds = self._make_FUT()
         ds.req = mock.Mock()
         mock_response = mock.Mock()
         mock_response.status_code = 500
-        ds.req.get.return_value = mock_response
+        ds.req.Session.return_value.get.return_value = mock_response
         assert_raises(Exception, ds._ensure_dashboard, "http://localhost")
 
     def test_create_datasources(self):
@@ -3,16 +3,23 @@ import os
 import time
 import unittest
 import uuid
+from collections import Counter
 
 import mock
 from botocore.exceptions import ClientError
-from nose.tools import eq_, assert_raises
+from nose.tools import eq_, assert_raises, ok_
 
 from tests import fixtures
 
 
 class TestAsyncPlanRunner(unittest.TestCase):
     def setUp(self):
+        self._env = mock.patch.dict(os.environ, {
+            "ec2_sg": "i-23232",
+            "metric_sg": "i-84828",
+            "metrics_bucket": "metrics",
+        })
+        self._env.start()
         self.mock_ecs = mock.Mock()
         self._patcher = mock.patch("ardere.step_functions.ECSManager")
         mock_manager = self._patcher.start()
@@ -26,6 +33,7 @@ class TestAsyncPlanRunner(unittest.TestCase):
 
     def tearDown(self):
         self._patcher.stop()
+        self._env.stop()
 
     def test_build_instance_map(self):
         result = self.runner._build_instance_map()
@@ -46,20 +54,36 @@ class TestAsyncPlanRunner(unittest.TestCase):
         eq_(self.runner.event["ecs_name"], "ardere-test")
 
     def test_populate_missing_instances(self):
-        os.environ["ec2_sg"] = "i-23232"
-        os.environ["metric_sg"] = "i-84828"
         self.mock_ecs.has_metrics_node.return_value = False
+        self.mock_ecs.query_active_instances.return_value = Counter()
         self.runner.populate_missing_instances()
-        self.mock_ecs.query_active_instances.assert_called()
+        eq_(self.mock_ecs.query_active_instances.call_count, 1)
         self.mock_ecs.request_instances.assert_called()
+        _, kwargs = self.mock_ecs.calculate_missing_instances.call_args
+        eq_(kwargs["current"], {"c4.large": 1})
 
     def test_populate_missing_instances_fail(self):
         from ardere.exceptions import ValidationException
-        mock_client = mock.Mock()
-        self.mock_boto.client.return_value = mock_client
-        mock_client.describe_clusters.return_value = {"clusters": []}
+        self.mock_ecs.start_cluster_check.return_value.result.return_value = \
+            False
         assert_raises(ValidationException,
                       self.runner.populate_missing_instances)
+        self.mock_ecs.request_instances.assert_not_called()
+        self.mock_boto.client.assert_not_called()
+
+    def test_populate_missing_instances_invalid_plan(self):
+        from ardere.exceptions import ValidationException
+        self.plan["steps"][0]["instance_type"] = "z9.huge"
+        assert_raises(ValidationException,
+                      self.runner.populate_missing_instances)
+        self.mock_ecs.start_cluster_check.assert_not_called()
+
+    def test_populate_missing_instances_invalid_max_workers(self):
+        from ardere.exceptions import ValidationException
+        self.plan["max_workers"] = "many"
+        assert_raises(ValidationException,
+                      self.runner.populate_missing_instances)
+        self.mock_ecs.start_cluster_check.assert_not_called()
 
     def test_ensure_metrics_available_running_create(self):
         from ardere.exceptions import ServicesStartingException
@@ -98,7 +122,6 @@ class TestAsyncPlanRunner(unittest.TestCase):
         assert_raises(Exception, self.runner.ensure_metrics_available)
 
     def test_ensure_metrics_available_running(self):
-        os.environ["metrics_bucket"] = "metrics"
         self.plan["metrics_options"] = dict(
             enabled=True,
             dashboard=dict(admin_user="admin",
@@ -119,7 +142,6 @@ class TestAsyncPlanRunner(unittest.TestCase):
         self.mock_ecs.locate_metrics_container_ip.assert_called()
 
     def test_ensure_metrics_available_running_no_metric_ip(self):
-        os.environ["metrics_bucket"] = "metrics"
         self.plan["metrics_options"] = dict(
             enabled=True,
             dashboard=dict(admin_user="admin",
@@ -144,28 +166,25 @@ class TestAsyncPlanRunner(unittest.TestCase):
         self.runner.ensure_metrics_available()
 
     def test_ensure_metric_sources_created(self):
-        os.environ["metrics_bucket"] = "metrics"
         self.plan["influxdb_private_ip"] = "1.1.1.1"
         self.plan["metrics_options"] = dict(
             enabled=True,
             dashboard=dict()
         )
-        self.mock_ecs.has_started_metric_creation.return_value = True
+        self.mock_ecs.metric_creation_state.return_value = (True, True)
         self.runner.ensure_metric_sources_created()
-        self.mock_ecs.has_started_metric_creation.assert_called()
+        self.mock_ecs.metric_creation_state.assert_called()
 
     def test_ensure_metric_sources_created_not_finished(self):
         from ardere.exceptions import CreatingMetricSourceException
-        os.environ["metrics_bucket"] = "metrics"
         self.plan["influxdb_private_ip"] = "1.1.1.1"
         self.plan["metrics_options"] = dict(
             enabled=True,
         )
-        self.mock_ecs.has_started_metric_creation.return_value = True
-        self.mock_ecs.has_finished_metric_creation.return_value = False
+        self.mock_ecs.metric_creation_state.return_value = (True, False)
         assert_raises(CreatingMetricSourceException,
                       self.runner.ensure_metric_sources_created)
-        self.mock_ecs.has_started_metric_creation.assert_called()
+        self.mock_ecs.metric_creation_state.assert_called()
 
     def test_ensure_metric_sources_created_not_enabled(self):
         self.plan["metrics_options"] = dict(
@@ -176,7 +195,6 @@ class TestAsyncPlanRunner(unittest.TestCase):
 
     def test_ensure_metric_sources_created_not_started(self):
         from ardere.exceptions import CreatingMetricSourceException
-        os.environ["metrics_bucket"] = "metrics"
         self.plan["influxdb_private_ip"] = "1.1.1.1"
         self.plan["metric_container_arn"] = "arn:::"
         self.plan["metrics_options"] = dict(
@@ -188,23 +206,22 @@ class TestAsyncPlanRunner(unittest.TestCase):
                 name="a title"
             )
         )
-        self.mock_ecs.has_started_metric_creation.return_value = False
+        self.mock_ecs.metric_creation_state.return_value = (False, False)
         assert_raises(CreatingMetricSourceException,
                       self.runner.ensure_metric_sources_created)
-        self.mock_ecs.has_started_metric_creation.assert_called()
+        self.mock_ecs.metric_creation_state.assert_called()
 
     def test_ensure_metric_sources_created_not_started_no_dash(self):
         from ardere.exceptions import CreatingMetricSourceException
-        os.environ["metrics_bucket"] = "metrics"
         self.plan["influxdb_private_ip"] = "1.1.1.1"
         self.plan["metric_container_arn"] = "arn:::"
         self.plan["metrics_options"] = dict(
             enabled=True,
         )
-        self.mock_ecs.has_started_metric_creation.return_value = False
+        self.mock_ecs.metric_creation_state.return_value = (False, False)
         assert_raises(CreatingMetricSourceException,
                       self.runner.ensure_metric_sources_created)
-        self.mock_ecs.has_started_metric_creation.assert_called()
+        self.mock_ecs.metric_creation_state.assert_called()
 
     def test_create_ecs_services(self):
         self.runner.create_ecs_services()
@@ -220,78 +237,147 @@ class TestAsyncPlanRunner(unittest.TestCase):
     def test_wait_for_cluster_ready_all_ready(self):
         self.mock_ecs.all_services_ready.return_value = True
         self.runner.wait_for_cluster_ready()
-        self.mock_ecs.all_services_ready.assert_called()
+        self.mock_ecs.all_services_ready.assert_called_with(
+            self.plan["steps"])
 
     def test_signal_cluster_start(self):
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
 
         self.runner.signal_cluster_start()
         self.mock_boto.client.assert_called()
+        _, kwargs = self.mock_boto.client.return_value.put_object.call_args
+        eq_(kwargs["Metadata"]["StartTime"].encode("ascii"), kwargs["Body"])
+        eq_(kwargs["Bucket"], self.mock_ecs.s3_ready_bucket)
+        eq_(kwargs["Key"], self.mock_ecs.s3_ready_key)
+        ok_(isinstance(kwargs["Body"], bytes))
+
+        # The S3 client is reused by later calls
+        self.runner.signal_cluster_start()
+        eq_(self.mock_boto.client.call_count, 1)
+        _, kwargs = self.mock_boto.client.call_args
+        eq_(kwargs["config"].retries["mode"], "adaptive")
 
     def test_check_for_cluster_done_not_done(self):
-        os.environ["s3_ready_bucket"] = "test_bucket"
-        mock_file = mock.Mock()
-        mock_file.get.return_value = {"Body": mock_file}
-        mock_file.read.return_value = "{}".format(
-            int(time.time()) - 100).encode(
-            'utf-8')
-        mock_s3_obj = mock.Mock()
-        mock_s3_obj.Object.return_value = mock_file
-        self.mock_boto.resource.return_value = mock_s3_obj
+        mock_s3 = mock.Mock()
+        mock_s3.head_object.return_value = {
+            "Metadata": {"starttime": str(int(time.time()) - 100)}
+        }
+        self.mock_boto.client.return_value = mock_s3
 
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
         self.runner.check_for_cluster_done()
+        mock_s3.get_object.assert_not_called()
 
     def test_check_for_cluster_done_shutdown(self):
         from ardere.exceptions import ShutdownPlanException
 
-        os.environ["s3_ready_bucket"] = "test_bucket"
-        mock_file = mock.Mock()
-        mock_file.get.return_value = {"Body": mock_file}
-        mock_file.read.return_value = "{}".format(
-            int(time.time()) - 400).encode(
-            'utf-8')
-        mock_s3_obj = mock.Mock()
-        mock_s3_obj.Object.return_value = mock_file
-        self.mock_boto.resource.return_value = mock_s3_obj
+        mock_s3 = mock.Mock()
+        mock_s3.head_object.return_value = {
+            "Metadata": {"starttime": str(int(time.time()) - 400)}
+        }
+        self.mock_boto.client.return_value = mock_s3
 
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
         assert_raises(ShutdownPlanException, self.runner.check_for_cluster_done)
 
-    def test_check_for_cluster_done_object_error(self):
+    def test_check_for_cluster_done_legacy_ready_file(self):
         from ardere.exceptions import ShutdownPlanException
 
-        os.environ["s3_ready_bucket"] = "test_bucket"
+        mock_s3 = mock.Mock()
+        mock_s3.head_object.return_value = {"Metadata": {}}
         mock_file = mock.Mock()
-        mock_file.get.return_value = {"Body": mock_file}
-        mock_file.read.return_value = "{}".format(
-            int(time.time()) - 400).encode(
+        mock_file.read.return_value = str(int(time.time()) - 400).encode(
             'utf-8')
-        mock_s3_obj = mock.Mock()
-        mock_s3_obj.Object.side_effect = ClientError(
-            {"Error": {}}, None
+        mock_s3.get_object.return_value = {"Body": mock_file}
+        self.mock_boto.client.return_value = mock_s3
+
+        self.plan["plan_run_uuid"] = str(uuid.uuid4())
+        assert_raises(ShutdownPlanException,
+                      self.runner.check_for_cluster_done)
+        mock_s3.get_object.assert_called_with(
+            Bucket=self.runner.ecs.s3_ready_bucket,
+            Key=self.runner.ecs.s3_ready_key
+        )
+
+    def test_check_for_cluster_done_legacy_ready_file_errors(self):
+        from ardere.exceptions import (
+            ReadyFileMissingException,
+            ShutdownPlanException,
+        )
+
+        mock_s3 = mock.Mock()
+        mock_s3.head_object.return_value = {"Metadata": {}}
+        self.mock_boto.client.return_value = mock_s3
+        self.plan["plan_run_uuid"] = str(uuid.uuid4())
+
+        # Deleted between the HEAD and the GET
+        mock_s3.get_object.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+        )
+        assert_raises(ReadyFileMissingException,
+                      self.runner.check_for_cluster_done)
+
+        mock_s3.get_object.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied"}}, "GetObject"
+        )
+        assert_raises(ShutdownPlanException,
+                      self.runner.check_for_cluster_done)
+
+    def test_check_for_cluster_done_missing(self):
+        from ardere.exceptions import ReadyFileMissingException
+
+        mock_s3 = mock.Mock()
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "404"}}, "HeadObject"
+        )
+        self.mock_boto.client.return_value = mock_s3
+
+        self.plan["plan_run_uuid"] = str(uuid.uuid4())
+        assert_raises(ReadyFileMissingException,
+                      self.runner.check_for_cluster_done)
+
+    def test_check_for_cluster_done_object_error(self):
+        from ardere.exceptions import ShutdownPlanException
+
+        mock_s3 = mock.Mock()
+        mock_s3.head_object.side_effect = ClientError(
+            {"Error": {"Code": "403"}}, "HeadObject"
         )
-        self.mock_boto.resource.return_value = mock_s3_obj
+        self.mock_boto.client.return_value = mock_s3
 
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
         assert_raises(ShutdownPlanException, self.runner.check_for_cluster_done)
 
+    def _use_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.mock_ecs._executor = ThreadPoolExecutor(max_workers=1)
+
     def test_cleanup_cluster(self):
+        self._use_executor()
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
 
         self.runner.cleanup_cluster()
-        self.mock_boto.resource.assert_called()
+        self.mock_boto.client.return_value.delete_object.assert_called()
 
     def test_cleanup_cluster_error(self):
+        self._use_executor()
         self.plan["plan_run_uuid"] = str(uuid.uuid4())
 
         mock_s3 = mock.Mock()
-        self.mock_boto.resource.return_value = mock_s3
-        mock_s3.Object.side_effect = ClientError(
+        self.mock_boto.client.return_value = mock_s3
+        mock_s3.delete_object.side_effect = ClientError(
             {"Error": {}}, None
         )
         self.runner.cleanup_cluster()
-        mock_s3.Object.assert_called()
+        mock_s3.delete_object.assert_called()
+
+    def test_cleanup_cluster_shutdown_error(self):
+        self._use_executor()
+        self.mock_ecs.shutdown_plan.side_effect = ClientError(
+            {"Error": {}}, "DeleteService"
+        )
+        assert_raises(ClientError, self.runner.cleanup_cluster)
+        self.mock_boto.client.return_value.delete_object.assert_called()
 
     def test_drain_check_draining(self):
         from ardere.exceptions import UndrainedInstancesException
@@ -309,7 +395,6 @@ class TestValidation(unittest.TestCase):
 
     def test_validate_success(self):
         schema = self._make_FUT()
-        schema.context["boto"] = mock.Mock()
         plan = json.loads(fixtures.sample_basic_test_plan)
         data, errors = schema.load(plan)
         eq_(errors, {})
@@ -317,7 +402,6 @@ class TestValidation(unittest.TestCase):
 
     def test_validate_fail_ecs_name(self):
         schema = self._make_FUT()
-        schema.context["boto"] = mock.Mock()
         plan = json.loads(fixtures.sample_basic_test_plan)
         plan['ecs_name'] = ''
         data, errors = schema.load(plan)
@@ -332,7 +416,6 @@ class TestValidation(unittest.TestCase):
 
     def test_validate_fail_step_name(self):
         schema = self._make_FUT()
-        schema.context["boto"] = mock.Mock()
         plan = json.loads(fixtures.sample_basic_test_plan)
         plan['steps'][0]['name'] = ''
         data, errors = schema.load(plan)
@@ -346,13 +429,31 @@ class TestValidation(unittest.TestCase):
         data, errors = schema.load(plan)
         eq_(errors, {'steps': {0: {'name': ['Step name too long']}}})
 
+    def test_validate_fail_instance_type(self):
+        schema = self._make_FUT()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan['steps'][0]['instance_type'] = 'z9.huge'
+        plan['metrics_options']['instance_type'] = 'z9.huge'
+        data, errors = schema.load(plan)
+        ok_('instance_type' in errors['steps'][0])
+        ok_('instance_type' in errors['metrics_options'])
+
     def test_validate_fail(self):
         schema = self._make_FUT()
-        schema.context["boto"] = mock_boto = mock.Mock()
-        mock_client = mock.Mock()
-        mock_boto.client.return_value = mock_client
-        mock_client.describe_clusters.return_value = {"clusters": []}
         plan = json.loads(fixtures.sample_basic_test_plan)
+        del plan["steps"][0]["run_max_time"]
         data, errors = schema.load(plan)
         eq_(len(data["steps"]), len(plan["steps"]))
         eq_(len(errors), 1)
+
+    def test_validate_max_workers(self):
+        schema = self._make_FUT()
+        plan = json.loads(fixtures.sample_basic_test_plan)
+        plan["max_workers"] = 16
+        data, errors = schema.load(plan)
+        eq_(errors, {})
+        eq_(data["max_workers"], 16)
+        for invalid in (0, 65, "many"):
+            plan["max_workers"] = invalid
+            data, errors = schema.load(plan)
+            ok_("max_workers" in errors)